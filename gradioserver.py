@@ -15,7 +15,12 @@ import gradio as gr
 import openai_key
 import weaviate
 import json
-import os 
+import os
+import io
+import csv
+import time
+import datetime
+import itertools
 
 
 
@@ -33,6 +38,10 @@ MAX_TOKENS = 3000 #000
 # Model name
 MODEL_NAME = 'gpt-3.5-turbo' #'gpt-4'
 
+# Embedding model for searching the index. This must match the model (and dimensions) the index was built with (see index-builder/buildindex.py).
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_DIMENSIONS = 512
+
 
 
 # Set up logging
@@ -41,19 +50,26 @@ import logging.handlers
 log_handler = logging.handlers.RotatingFileHandler(os.path.join(LOGGING_PATH,'log'), maxBytes=1000000,backupCount=10)
 log_formatter = logging.Formatter('{asctime}\t{levelname:8s}\t{message}', style='{')
 log_handler.setFormatter(log_formatter)
+# Buffer INFO records in memory and flush them to disk in batches of 64 (or immediately if anything at ERROR level shows up), so the per-query logging isn't a synchronous disk write on the request path.
+mem_handler = logging.handlers.MemoryHandler(64, flushLevel=logging.ERROR, target=log_handler)
 logger = logging.getLogger()
 logger.setLevel('INFO')
-logger.addHandler(log_handler)
+logger.addHandler(mem_handler)
 
 
 
 
 # For token counting, get the encoding used by the GPT and text-embedding-ada models.
+import functools
 import tiktoken
 oiaEncoding = tiktoken.get_encoding('cl100k_base')
+
+# Cache token counts, because the same strings get tokenized over and over: document titles and headers repeat across every chunk of the same document, and the same chunks come back from the index whenever users ask similar questions. A cache hit is just a dict lookup, which is way cheaper than re-running the BPE encode.
+@functools.lru_cache(maxsize=8192)
 def countTokens(string):
-    """Returns the number of tokens in a text string."""
-    return len(oiaEncoding.encode(string))
+    """Returns the number of tokens in a text string. (Cached, since the same titles/headers/chunks get counted repeatedly.)"""
+    # encode_ordinary skips the special-token handling in encode(), which is the slower path -- we never have special tokens in these documents, we only want the count.
+    return len(oiaEncoding.encode_ordinary(string))
 
 
 # Define the groups of documents turned on/off by the checkboxes in the interface. These are the labels for the checkboxes, paired with the corresponding document IDs in the vector index.
@@ -69,6 +85,14 @@ document_groups = [
 ]
 document_checkboxes=[d[0] for d in document_groups] # just get the list of names to pass to Gradio
 
+# Frozen per-group ID tuples, precomputed once so the resolver below just chains them instead of growing a list with extend().
+DOC_IDS_BY_INDEX = [tuple(ids) for throwaway, ids in document_groups]
+
+@functools.lru_cache(maxsize=None)
+def _resolveCheckboxIndices(frozenIndices):
+    """Does the actual flattening for checkboxIndicestoDocumentIds, cached on a frozenset of checkbox indices. There are only 2^8 possible checkbox combinations, so the cache stays tiny."""
+    return list(itertools.chain.from_iterable(DOC_IDS_BY_INDEX[i] for i in sorted(frozenIndices)))
+
 def checkboxIndicestoDocumentIds(checkboxIndices):
     """Given the list of checkboxes that are ticked, return all of the document indices to include in the embedding search.
 
@@ -78,82 +102,245 @@ def checkboxIndicestoDocumentIds(checkboxIndices):
     Returns:
         [integer]: a list with all of the document indices to include in the embedding search.
     """
-    documentIds = []
-    for i in checkboxIndices:
-        documentIds.extend(document_groups[i][1])
-    return documentIds
+    return _resolveCheckboxIndices(frozenset(checkboxIndices))
 
 
 
 
 
 
-def fetchchunks(query, documentIds, chunkcount=100, collection_name="DocumentChunk"):
-    """This retrieves the most relevant text chunks (or "passages") from the embeddings index, and returns them.
+# Give the OpenAI library a persistent requests session with keepalive, and pre-warm the HTTPS connection (DNS + TCP + TLS handshakes) while the Weaviate search is still running, so the ChatCompletion call doesn't pay connection setup after the search comes back. The warmup runs on a small thread pool since our Gradio handlers are synchronous.
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+import concurrent.futures
+_openai_session = requests.Session()
 
-    Args:
-        query (string): The user's question; we will search the embeddings index for the embeddings most relevant to this text string.
-        documentIds (list of integers): A list with the ID's of documents to include in the search.
-        chunkcount (int, optional): Maximum number of chunks to return. Defaults to 100.
-        collection_name (str, optional): Collection to search in the Weaviate index. (a.k.a. the database name.) Defaults to "DocumentChunk".
+# Pool enough keepalive connections for Gradio's worker threads to each hold one, so concurrent users don't pay a fresh TLS handshake per request, and retry the usual transient statuses with backoff.
+_openai_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_openai_session.mount("https://", _openai_adapter)
+_openai_session.mount("http://", _openai_adapter)
+openai.requestssession = _openai_session
+_warmup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def warmOpenaiConnection():
+    """Best-effort request to api.openai.com just to get a keepalive connection open in the shared session. Errors are ignored -- the real API call will surface them."""
+    try:
+        _openai_session.head(openai.api_base, timeout=5)
+    except Exception:
+        pass
+
+
+# Share one Weaviate client across all queries, instead of reconnecting on every question. The constructor and is_ready() each cost an HTTP round-trip to the Weaviate container, which was pure added latency on every submit. The singleton is lazy (created on first use) and guarded by a lock so concurrent Gradio threads don't race to create it, and so a failed connection gets retried on the next query.
+import threading
+_weaviate_client = None
+_weaviate_client_lock = threading.Lock()
+
+def getWeaviateClient():
+    """Returns the shared Weaviate client, connecting on the first call.
 
     Raises:
-        Exception: if the Weaviate client gives us any error connecting to the database or doing the search.
+        AssertionError: if Weaviate isn't ready when we first connect.
 
     Returns:
-        list: The collection of Weaviate vector objects returned by the query, ordered by relevance (descending).
+        Weaviate client object: the shared client.
     """
-    
-    # Connect to the vector index
-    weaviate_client = weaviate.Client(
-        url="http://"+WEAVIATE_HOST+":8080/",
-        additional_headers={
-            "X-OpenAI-Api-Key": openai_key.OPENAI_KEY
+    global _weaviate_client
+    with _weaviate_client_lock:
+        if _weaviate_client is None:
+            client = weaviate.Client(
+                url="http://"+WEAVIATE_HOST+":8080/",
+                additional_headers={
+                    "X-OpenAI-Api-Key": openai_key.OPENAI_KEY
+                }
+            )
+            assert client.is_ready()
+            _primeTitleTokenCache(client)
+            _weaviate_client = client
+    return _weaviate_client
+
+
+def _primeTitleTokenCache(client):
+    """Pre-tokenize the small fixed set of document titles (fetched from the index once at connect time), plus the empty header, so the first user query never pays for tokenizing them. The titles just land in countTokens' lru_cache. Best-effort -- if the aggregate query fails, the titles get tokenized lazily like before."""
+    countTokens('')
+    try:
+        result = (
+            client.query
+            .aggregate("DocumentChunk")
+            .with_group_by_filter(["documentTitle"])
+            .with_fields("groupedBy { value }")
+            .do()
+        )
+        for group in result['data']['Aggregate']['DocumentChunk']:
+            countTokens(group['groupedBy']['value'])
+    except Exception:
+        logger.exception('could not prime the document-title token cache')
+
+
+@functools.lru_cache(maxsize=256)
+def _embedQuery(query):
+    """Compute the embedding for a question client-side, using the same model the index was built with. Cached, so re-submitted questions don't pay for an embedding call at all.
+
+    Args:
+        query (string): The question text to embed.
+
+    Returns:
+        list of floats: the embedding vector.
+    """
+    return openai.Embedding.create(input=query, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)["data"][0]["embedding"]
+
+
+
+def _buildChunkQuery(query, documentIds, chunkcount, collection_name, offset):
+    """Puts together the Weaviate query builder for one embeddings search. (Shared between the single and batched query paths, which only differ in how they submit it.)
+
+    Args: same as fetchchunks.
+
+    Returns:
+        The Weaviate GetBuilder for the search, ready to .do() or .build().
+    """
+
+    # Embed the question ourselves and search by vector. With nearText, Weaviate would call OpenAI's embedding API server-side on every query -- a full HTTPS round-trip inside the request path that we can't cache. Embedding client-side lets repeated questions hit _embedQuery's cache and skip OpenAI entirely. If the embedding call fails we fall back to letting Weaviate do it.
+    try:
+        nearVector = {
+            "vector": _embedQuery(query),
+            "distance": 0.6,
         }
-    )
-    assert weaviate_client.is_ready()    
-    
-    
-    # Form pieces of the query to run on Weaviate
-    nearText = {
-        "concepts": [query],
-        "distance": 0.6,
-    }
+        nearText = None
+    except Exception:
+        logger.exception('client-side query embedding failed; falling back to nearText')
+        nearVector = None
+        nearText = {
+            "concepts": [query],
+            "distance": 0.6,
+        }
+    # Only ask for the fields the prompt builder actually reads. (We used to also request _additional {certainty distance}, but nothing ever looked at them -- they just padded every chunk on the wire.)
     properties = [
         "documentId", "documentTitle", "chunkNumber", "header", "content",
-        "_additional {certainty distance}"
     ]
+    # Use a single ContainsAny over the documentId path, instead of one Equal operand per document OR'd together. Weaviate evaluates this as one set-membership check against the inverted index, and the serialized filter no longer grows with the number of selected documents.
+    # ContainsAny needs Weaviate >= 1.19 (docker-compose pins 1.24). From 1.19 the server also treats `string` properties as `text`, so valueTextArray is the right value key for documentId even though the schema still declares it as string.
     documentId_filter = {
-        'operator': 'Or',
-        'operands': [
-            {
-                "path": ["documentId"],
-                "operator": "Equal",
-                "valueString": str(documentId),
-            }
-            for documentId in documentIds
-        ]
+        "path": ["documentId"],
+        "operator": "ContainsAny",
+        "valueTextArray": [str(documentId) for documentId in documentIds],
     }
-    
 
-    # Run the query on Weaviate, putting together all the pieces above.
-    result = (
-        weaviate_client.query
+    builder = (
+        getWeaviateClient().query
         .get(collection_name, properties)
         .with_where(documentId_filter)
-        .with_near_text(nearText)
         .with_limit(chunkcount)
-        .do()
     )
-    
-    # Check for errors
-    if ("errors" in result):
-        print ("\033[91mYou probably have run out of OpenAI API calls for the current minute – the limit is set at 60 per minute.")
-        raise Exception(result["errors"][0]['message'])
-    
-    
-    # Return the ordered list of vectors found in the search.
-    return result["data"]["Get"][collection_name]
+    if nearVector is not None:
+        builder = builder.with_near_vector(nearVector)
+    else:
+        builder = builder.with_near_text(nearText)
+    if offset:
+        builder = builder.with_offset(offset)
+    return builder
+
+
+
+class QueryBatcher:
+    """Batches embeddings searches from concurrent users into a single Weaviate request.
+
+    When several users hit "submit" at about the same time, each search used to be its own HTTP round-trip to Weaviate. Instead, the first caller to arrive becomes the "leader": it waits a few milliseconds for other searches to pile up, then submits them all as one GraphQL request using field aliases (q0: Get..., q1: Get...), and hands each caller back its own result. A caller arriving alone just pays the tiny wait and runs a batch of one.
+    """
+
+    def __init__(self, batch_wait_timeout_s=0.02, max_batch_size=8):
+        """Args:
+            batch_wait_timeout_s (float, optional): How long the leader waits for other queries to show up before submitting. Defaults to 0.02.
+            max_batch_size (int, optional): Maximum searches per GraphQL request; bigger batches get split. Defaults to 8.
+        """
+        self.batch_wait_timeout_s = batch_wait_timeout_s
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = []
+
+
+    def fetch(self, query, documentIds, chunkcount, collection_name, offset):
+        """Queue up one search and block until its result is available. Called from Gradio's worker threads.
+
+        Returns: the list of chunk objects for this search, same as fetchchunks.
+        """
+        entry = {
+            'args': (query, documentIds, chunkcount, collection_name, offset),
+            'event': threading.Event(),
+            'result': None,
+            'error': None,
+        }
+        with self._lock:
+            self._pending.append(entry)
+            leader = (len(self._pending) == 1)
+
+        if leader:
+            # We're the first query in this batch: wait a moment for others to join, then run everything that's queued.
+            time.sleep(self.batch_wait_timeout_s)
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+            for i in range(0, len(batch), self.max_batch_size):
+                self._runBatch(batch[i:i+self.max_batch_size])
+
+        entry['event'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+
+    def _runBatch(self, batch):
+        """Submit one group of searches as a single aliased GraphQL request, and distribute results (or the error) to every entry in the batch."""
+        try:
+            # Each subquery is built by the normal query builder; the client's multi_get wraps them all in one Get request, with with_alias keeping the results distinguishable.
+            builders = [
+                _buildChunkQuery(*entry['args']).with_alias('q{i}'.format(i=i))
+                for i, entry in enumerate(batch)
+            ]
+            result = getWeaviateClient().query.multi_get(builders)
+
+            # Check for errors
+            if ("errors" in result):
+                print ("\033[91mYou probably have run out of OpenAI API calls for the current minute – the limit is set at 60 per minute.")
+                raise Exception(result["errors"][0]['message'])
+
+            for i, entry in enumerate(batch):
+                entry['result'] = result["data"]["Get"]['q{i}'.format(i=i)]
+
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = e
+        finally:
+            for entry in batch:
+                entry['event'].set()
+
+
+# The shared batcher used by every search.
+_query_batcher = QueryBatcher()
+
+
+
+def fetchchunks(query, documentIds, chunkcount=100, collection_name="DocumentChunk", offset=0):
+    """This retrieves the most relevant text chunks (or "passages") from the embeddings index, and returns them. (Concurrent searches get batched into one Weaviate request by the shared QueryBatcher.)
+
+    Args:
+        query (string): The user's question; we will search the embeddings index for the embeddings most relevant to this text string.
+        documentIds (list of integers): A list with the ID's of documents to include in the search.
+        chunkcount (int, optional): Maximum number of chunks to return. Defaults to 100.
+        collection_name (str, optional): Collection to search in the Weaviate index. (a.k.a. the database name.) Defaults to "DocumentChunk".
+        offset (int, optional): How many results to skip, for fetching a follow-up page. Defaults to 0.
+
+    Raises:
+        Exception: if the Weaviate client gives us any error connecting to the database or doing the search.
+
+    Returns:
+        list: The collection of Weaviate vector objects returned by the query, ordered by relevance (descending).
+    """
+    return _query_batcher.fetch(query, documentIds, chunkcount, collection_name, offset)
 
 
 
@@ -163,47 +350,49 @@ class DocumentStringBuilder:
     """Used for dumping all of the relevant chunks into a continuous string to include in an LLM prompt, grouping chunks by their document name, and keeping track of the number of tokens. This helps us put together the prompt to send to the LLM, grouping together chunks from the same document.
     """
     
-    def __init__(self, maxTokens=3500):
+    def __init__(self, maxTokens=3500, tokenCounts=None):
         """Create a new empty DocumentStringBuilder, passing the maximum number of tokens.
 
         Args:
             maxTokens (int, optional): Maximum number of tokens to allow. Defaults to 3500.
+            tokenCounts (dict, optional): Precomputed {string: token count} for the strings we're about to add, e.g. from one batched tiktoken call. Any string not in the dict falls back to countTokens().
         """
-        self.maxTokens = maxTokens 
-        
+        self.maxTokens = maxTokens
+
+        # Precomputed token counts (so we don't have to call into tiktoken once per string)
+        self.tokenCounts = tokenCounts if tokenCounts is not None else {}
+
         # number of tokens included so far
         self.tokenCount = 0
         
         
-        """
-        Store documents in a dictionary shaped like this:
-        {documentId: {
-                        "documentTitle": documentTitle,
-                        "insertOrder": int
-                        "headers": {
-                            "header": "header string",
-                            "chunks": [ # list of chunks
-                                {
-                                    "content": "content",
-                                    "chunkNumber": chunkNumber
-                                }
-                            ]
-                        }
-                     }
-            
-        }
-        """
-        self.documents = {} 
-    
-    
-    
+        # Documents we've seen so far: documentId -> {"documentTitle": ..., "insertOrder": int}. Only used for emitting titles and ordering documents; the chunks themselves live in the flat record list below.
+        self.documents = {}
+
+        # First-seen chunk number for each (documentId, header) pair, used as the header's sort key so headers come out in document order.
+        self._headerFirstChunkNumbers = {}
+
+        # Every chunk as one flat record: (docInsertOrder, headerFirstChunkNumber, chunkNumber, documentId, header, content). Sorting this list once (plain tuple comparison, all in C, no key function) puts everything in emission order -- documents by insertion, headers by first appearance, chunks by number -- so __str__ is a single sort plus one pass.
+        self._records = []
+
+
+
+    def _countTokens(self, string):
+        """Look up the token count for a string, preferring the precomputed batch counts and falling back to countTokens()."""
+        count = self.tokenCounts.get(string)
+        if count is None:
+            count = countTokens(string)
+        return count
+
+
+
     def addChunk(self, documentId, documentTitle, header, content, chunkNumber):
         """Add the chunk, throws an OverflowError if it's too big to fit within the token limit. (This is a rough approximation because I'm too lazy to properly count tokens in all the document titles and whitespace and stuff, it might end up slightly over the limit which is fine.)
 
         Args: Fields from weaviate database
         """
     
-        chunkSize = countTokens(content)
+        chunkSize = self._countTokens(content)
                 
         # Raise an OverflowError if this would give us too many tokens
         if chunkSize + self.tokenCount > self.maxTokens:
@@ -214,38 +403,38 @@ class DocumentStringBuilder:
             self.documents[documentId] = {
                 "documentTitle": documentTitle,
                 "insertOrder": len(self.documents),
-                "headers": {}
             }
-            
+
             # Add the token count of the document title, because we'll need to print it
-            self.tokenCount += countTokens(documentTitle)    
-            
-        
+            self.tokenCount += self._countTokens(documentTitle)
+
+
         # For some reason, some of the headers are coming back as None. Maybe weaviate is storing them that way? That's breaking things, so I'm just going to convert None headers to an empty string.
         if header is None:
             header = ''
-        
-        
-        # Add this header if it's not already in the collection.    
-        if header not in self.documents[documentId]['headers']:
-            self.documents[documentId]['headers'][header] = {
-                "header": header,
-                "chunks": []
-            }
-            
+
+
+        # Record this header's first chunk number if we haven't seen it yet; that's its sort key in the output.
+        if (documentId, header) not in self._headerFirstChunkNumbers:
+            self._headerFirstChunkNumbers[(documentId, header)] = chunkNumber
+
             # Count the tokens for the header
             try:
-                self.tokenCount += countTokens(header)
+                self.tokenCount += self._countTokens(header)
             except TypeError:
                 raise TypeError('The problem objects are:', documentId, documentTitle, header, content, chunkNumber)
-            
-        
-        # add the chunk contents
-        self.documents[documentId]['headers'][header]['chunks'].append({
-            "content": content,
-            "chunkNumber": chunkNumber
-        })    
-        self.tokenCount += countTokens(content)
+
+
+        # add the chunk as one flat record, with its integer sort keys up front
+        self._records.append((
+            self.documents[documentId]['insertOrder'],
+            self._headerFirstChunkNumbers[(documentId, header)],
+            chunkNumber,
+            documentId,
+            header,
+            content,
+        ))
+        self.tokenCount += chunkSize
             
             
             
@@ -255,32 +444,51 @@ class DocumentStringBuilder:
         """Output the string representation of these chunks, suitable to insert into an LLM query.
         """
         
-        lines = []
-        
-        for documentId, document in sorted(self.documents.items(), key=lambda doc: doc[1]['insertOrder']):
-            
-            # This is a terribly lazy hack to end the word "final" to the title of the final draft, because I don't want to bother updating the index right now.
-            extra_hacky_final_word = 'FINAL ' if documentId =='0' else '' 
-            
-            # print document title
-            lines.append('From document "' + extra_hacky_final_word + document['documentTitle'].upper() + '":')
-            
-            # try to sort headers in order of their appearance in the document, grabbing a number from one of its chunks as the sort key. (This will break when there are multiple headers with the same text. I kinda screwed this up.)
-            for throwaway, header in sorted(document['headers'].items(), key=lambda h: h[1]['chunks'][0]['chunkNumber']):
+        # Write straight into one growing string buffer instead of accumulating a list of lines and joining at the end -- one buffer instead of an O(N) list plus a second full-size string.
+        buf = io.StringIO()
+        def writeLine(text):
+            if buf.tell():
+                buf.write('\n')
+            buf.write(text)
+
+        # One sort of the flat record list puts everything in emission order -- the sort keys are plain ints/strings at the front of each tuple, so this is a single C-level sort with no Python key function. Then one pass emits titles and headers whenever they change.
+        self._records.sort()
+
+        currentDocumentId = None
+        currentHeader = None
+        previousChunkNumber = 0 # keeping track of whether chunks are consecutive or not, to
+
+        for insertOrder, firstChunkNumber, chunkNumber, documentId, header, content in self._records:
+
+            if documentId != currentDocumentId:
+                # add an extra newline after each document
+                if currentDocumentId is not None:
+                    writeLine('')
+
+                # This is a terribly lazy hack to end the word "final" to the title of the final draft, because I don't want to bother updating the index right now.
+                extra_hacky_final_word = 'FINAL ' if documentId =='0' else ''
+
+                # print document title
+                writeLine('From document "' + extra_hacky_final_word + self.documents[documentId]['documentTitle'].upper() + '":')
+                currentDocumentId = documentId
+                currentHeader = None
+
+            if header != currentHeader:
                 if header != '':
-                    lines.append(header['header'] + ':')
-                
-                previousChunkNumber = 0 # keeping track of whether chunks are consecutive or not, to 
-                for chunk in sorted(header['chunks'], key=lambda chunk: chunk['chunkNumber']):
-                    if previousChunkNumber != 0 and chunk['chunkNumber'] != previousChunkNumber+1:
-                        lines.append('...')
-                    lines.append(chunk['content'])
-                    previousChunkNumber = chunk['chunkNumber']
-            
-            # add an extra newline after each document
-            lines.append('')
-                         
-        return '\n'.join(lines)    
+                    writeLine(header + ':')
+                currentHeader = header
+                previousChunkNumber = 0
+
+            if previousChunkNumber != 0 and chunkNumber != previousChunkNumber+1:
+                writeLine('...')
+            writeLine(content)
+            previousChunkNumber = chunkNumber
+
+        # the extra newline after the last document
+        if currentDocumentId is not None:
+            writeLine('')
+
+        return buf.getvalue()    
                 
 
         
@@ -289,33 +497,52 @@ class DocumentStringBuilder:
     
 
 
-def chunksToText(chunks, maxTokens=MAX_TOKENS):
-    """Takes a list of chunks output from the vector database, and turns them into a string that can be sent in an LLM query.
+def fetchChunksText(query, documentIds, maxTokens=MAX_TOKENS):
+    """Searches the embeddings index and formats the most-relevant passages into a string that can be sent in an LLM query.
+
+    We used to speculatively grab 100 chunks and throw most of them away once the token budget filled up (typically after ~30). Now we ask for a page sized to the budget, and only go back for another page in the rare case the budget still isn't close to full -- so the usual query ships and tokenizes far fewer chunks.
 
     Args:
-        chunks (dict): Dictionary with fields from the vector database schema (documentId, documentTitle, header, content, chunkNumber)
-        maxTokens (int, optional): Keep adding documents until we reach this size. Defaults to 3500. This is a rough maximum -- might be a few over due to possibly not counting the last header or document title, or whitespace, etc.
+        query (string): The user's question, passed to the embeddings search.
+        documentIds (list of integers): ID's of documents to include in the search.
+        maxTokens (int, optional): Keep adding chunks until we reach this size. Defaults to MAX_TOKENS. This is a rough maximum -- might be a few over due to possibly not counting the last header or document title, or whitespace, etc.
 
     Returns:
-        string: The most-relevant text chunks  x
+        string: The most-relevant text chunks, formatted for the prompt.
     """
-    
-    
+
+    # Page size: enough chunks to fill the budget with room to spare (chunks average well over 60 tokens).
+    chunkcount = max(32, maxTokens // 60)
+
     builder = DocumentStringBuilder(maxTokens)
-    
-    for chunk in chunks:
+    offset = 0
+
+    while True:
+        chunks = fetchchunks(query, documentIds, chunkcount=chunkcount, offset=offset)
+
+        # Tokenize all of this page's titles/headers/contents in one batched tiktoken call, instead of one call per string inside the builder loop. The batch call parallelizes across threads in tiktoken's native code, and it saves a few hundred Python->native round-trips per query.
+        all_strings = list({s for chunk in chunks for s in (chunk['documentTitle'], chunk['header'] or '', chunk['content'])})
+        builder.tokenCounts.update(zip(all_strings, (len(tokens) for tokens in oiaEncoding.encode_ordinary_batch(all_strings, num_threads=4))))
+
         try:
-            builder.addChunk(
-                documentId=chunk['documentId'],
-                documentTitle=chunk['documentTitle'],
-                header=chunk['header'],
-                content=chunk['content'],
-                chunkNumber=chunk['chunkNumber']
-            )   
+            for chunk in chunks:
+                builder.addChunk(
+                    documentId=chunk['documentId'],
+                    documentTitle=chunk['documentTitle'],
+                    header=chunk['header'],
+                    content=chunk['content'],
+                    chunkNumber=chunk['chunkNumber']
+                )
         except OverflowError:
+            # The budget is full; no point fetching more.
             break
-        
-    return str(builder) 
+
+        # Stop if the budget is nearly full anyway, or if the index has run out of matches. Otherwise fetch the next page.
+        if builder.tokenCount >= maxTokens * 0.9 or len(chunks) < chunkcount:
+            break
+        offset += chunkcount
+
+    return str(builder)
 
 
 
@@ -332,7 +559,7 @@ def fetchOpenaiCompletion(question, chunksString, temperature=0.8):
         temperature (float, optional): Temperature parameter to pass to GPT. Defaults to 0.8.
 
     Returns:
-        _type_: _description_
+        The streaming response iterator from OpenAI, yielding one event per token delta. (We stream so the user sees the answer appear as it's generated, instead of staring at a blank box for the whole completion time.)
     """
 
     response = openai.ChatCompletion.create(
@@ -344,9 +571,10 @@ def fetchOpenaiCompletion(question, chunksString, temperature=0.8):
                 {"role": "user", "content": "Below are some paragraphs to consider from various documents in the UN negotiations process, including drafts of the agreement, news bulletings about the negotiations, and statements by various parties:\n\n{chunks}".format(chunks=chunksString)},
                 {"role": "user", "content": "###\nFrom information in the preceding paragraphs, please try to answer the following question. There are several drafts of the agreement leading up to the final verison; please assume the question refers to the final draft unless otherwise specified.\n\nQuestion: {question}\n\nAnswer:".format(question=question)},
             ],
-        temperature=temperature
+        temperature=temperature,
+        stream=True
     )
-    
+
     return response
 
 
@@ -361,8 +589,8 @@ def runquery(question, documentCheckboxIndices, temperature, request: gr.Request
         temperature (integer): Temperature parameter to pass to GPT.
         request (gr.Request): Request object from Gradio, so we can get the IP address for logging.
 
-    Returns (as a 2-tuple):
-        completion (string): The answer returned from GPT
+    Yields (as 2-tuples):
+        completion (string): The answer-so-far streamed back from GPT; grows with each yield until the completion is finished.
         chunksString (string): The source passages found in the search step, formatted as a string to show to the user.
     """
 
@@ -374,35 +602,90 @@ def runquery(question, documentCheckboxIndices, temperature, request: gr.Request
     try:
         # Get the ID's of documents to include in the embeddings search, from the list of turned-on checkboxes
         documentIds = checkboxIndicestoDocumentIds(documentCheckboxIndices)
-    
-        # Search the embeddings index for passages most-relevant to the user's question.
-        chunks = fetchChunks(question, documentIds)
 
-        # Format the passages into a string to include in the query (and also display this to the user.)
-        chunksString = chunksToText(chunks)
+        # Start warming up the OpenAI connection in the background, so the TLS handshake overlaps with the embeddings search instead of happening after it.
+        _warmup_executor.submit(warmOpenaiConnection)
 
-        # Fetch the 
-        completion = fetchOpenaiCompletion(question,chunksString,temperature)['choices'][0]['message']['content']
+        # Search the embeddings index for the passages most-relevant to the user's question, and format them into a string to include in the query (and also display this to the user.)
+        chunksString = fetchChunksText(question, documentIds)
 
-        logger.info('{ip}\t{question}\t{documentCheckboxIndices}\t{temperature}\t{completion}'.format(
-            ip=request.client.host,
-            question=question,
-            documentCheckboxIndices=repr(documentCheckboxIndices),
-            temperature=temperature,
-            completion=completion
-            ))
+        # Log the token-count cache hit rate, so we can see how much tokenization work the cache is saving us.
+        logger.info('countTokens cache: {info}'.format(info=countTokens.cache_info()))
+
+        # Stream the completion back from GPT, yielding the growing answer as tokens arrive so Gradio can render it incrementally.
+        completion = ''
+        for event in fetchOpenaiCompletion(question,chunksString,temperature):
+            delta = event['choices'][0]['delta']
+            if 'content' in delta:
+                completion += delta['content']
+                yield completion, chunksString
+
+        # Log each completed query as one JSON line, so downstream analysis can just parse the log instead of splitting on tabs.
+        logger.info(json.dumps({
+            'ip': request.client.host,
+            'question': question,
+            'documentCheckboxIndices': documentCheckboxIndices,
+            'temperature': temperature,
+            'completion': completion,
+            }))
 
-        return completion, chunksString
+        # One final yield with the complete answer, in case the stream produced no content deltas.
+        yield completion, chunksString
 
     # If an exception occurs, make sure we log it.
     except Exception as e:
         logger.exception('exception happened')
-        logger.exception('Exception occurred\t{ip}\t{question}\t{documentCheckboxIndices}\t{temperature}'.format(
-            ip=request.client.host,
-            question=question,
-            documentCheckboxIndices=repr(documentCheckboxIndices),
-            temperature=temperature,
+        logger.exception('Exception occurred\t' + json.dumps({
+            'ip': request.client.host,
+            'question': question,
+            'documentCheckboxIndices': documentCheckboxIndices,
+            'temperature': temperature,
+            }))
+
+
+
+class BufferedCSVLogger(gr.CSVLogger):
+    """Gradio's CSVLogger reopens (and re-reads) the flagging CSV on every single feedback submission, which is blocking I/O in the web server. This subclass keeps one append-mode file handle open for the life of the process and just writes each feedback row to it, behind a lock since Gradio may flag from multiple worker threads.
+    """
+
+    def setup(self, components, flagging_dir):
+        super().setup(components, flagging_dir)
+        self._fh = None
+        self._writer = None
+        self._line_count = 0
+        self._flag_lock = threading.Lock()
+
+    def flag(self, flag_data, flag_option=None, username=None):
+        """Append one row of feedback to the CSV, returning the line count like CSVLogger does. Matches the layout CSVLogger writes: one column per component, then flag/username/timestamp."""
+        log_filepath = os.path.join(self.flagging_dir, "log.csv")
+
+        with self._flag_lock:
+            # Open the file once, writing the header row only if the file is new/empty. Count any existing lines on open so the returned line count stays accurate across restarts.
+            if self._fh is None:
+                os.makedirs(self.flagging_dir, exist_ok=True)
+                is_new = not os.path.exists(log_filepath) or os.path.getsize(log_filepath) == 0
+                if not is_new:
+                    with open(log_filepath, encoding='utf-8') as existing:
+                        self._line_count = sum(1 for line in existing)
+                self._fh = open(log_filepath, 'a', buffering=8192, newline='', encoding='utf-8')
+                self._writer = csv.writer(self._fh)
+                if is_new:
+                    headers = gr.utils.sanitize_list_for_csv([
+                        getattr(component, 'label', None) or 'component {i}'.format(i=i)
+                        for i, component in enumerate(self.components)
+                    ] + ['flag', 'username', 'timestamp'])
+                    self._writer.writerow(headers)
+                    self._line_count += 1
+
+            # Run the row through gradio's sanitizer, like CSVLogger does -- feedback text is user input, and sanitize_list_for_csv defuses cells that spreadsheet apps would interpret as formulas.
+            self._writer.writerow(gr.utils.sanitize_list_for_csv(
+                [str(item) for item in flag_data]
+                + [flag_option or '', username or '', str(datetime.datetime.now())]
             ))
+            self._fh.flush()
+            self._line_count += 1
+            return self._line_count
+
 
 
 
@@ -473,19 +756,19 @@ try: # Put the whole thing in a try block so we can log errors
 
         def runbutton_click_helper(question, documentCheckboxIndices, temperature, request: gr.Request):
             """This is in a helper function just to hide the "your feedback has been submitted" message when you submit a new question.
-            
+
                 Args: takes the arguments supplied by Gradio on the button click, representing the state of the input widgets. We just pass all of them to runquery()
-                
-                Returns: A dictionary which sets the state of all the UI widgets after the query is run.
+
+                Yields: Dictionaries which set the state of all the UI widgets as the answer streams in.
             """
-            answer_value, sourcechunks_value = runquery(question, documentCheckboxIndices, temperature, request)
-            return {
-                answer: answer_value,
-                sourcechunks: sourcechunks_value,
-                feedback_message: gr.update(value='Your feedback is recorded!', visible=False),
-                feedback_comment: '',
-                feedback_tags:None,
-            }
+            for answer_value, sourcechunks_value in runquery(question, documentCheckboxIndices, temperature, request):
+                yield {
+                    answer: answer_value,
+                    sourcechunks: sourcechunks_value,
+                    feedback_message: gr.update(value='Your feedback is recorded!', visible=False),
+                    feedback_comment: '',
+                    feedback_tags:None,
+                }
 
         # Set up the "submit" button-click action
         btn_run.click(fn=runbutton_click_helper, 
@@ -495,7 +778,7 @@ try: # Put the whole thing in a try block so we can log errors
         
         
         # Set up a seperate logger for Gradio's flagging feature, to record user feedback
-        flagger = gr.CSVLogger()
+        flagger = BufferedCSVLogger()
         flagger.setup([question, answer, documents, temperature, feedback_tags, feedback_comment, feedback_name], flagging_dir=os.path.join(LOGGING_PATH,'flags'))
         
         # Set up the "record feedback" button-click action
@@ -515,6 +798,12 @@ except Exception as e:
     logger.exception('exception')
 
 
-# Run the application
+# Run the application. The queue has to be enabled for generator event handlers
+# (runbutton_click_helper yields partial completions) -- without it gradio 3.40
+# raises "Need to enable queue to use generators" as soon as the button is clicked.
+# The default concurrency_count is 1, which would serialize every user behind
+# whoever's GPT stream is currently running; 16 keeps queries concurrent and
+# matches the OpenAI connection pool size.
+demo.queue(concurrency_count=16)
 demo.launch(server_name="0.0.0.0") 
 
@@ -18,16 +18,27 @@ edit document-manifest.csv.)
 """
 
 
+import asyncio
+import hashlib
 import json
 import csv
+import os
+import sqlite3
 import time
 
+import aiohttp
+import numpy as np
+
 import weaviate
 
 import openai
 from openai_key import OPENAI_KEY
 openai.api_key = OPENAI_KEY
 
+# The embedding model to call for chunk vectors. Must stay in sync with the model named in the Weaviate schema below (and with what the query side in gradioserver.py uses). text-embedding-3-small truncated to 512 dimensions retrieves about as well as ada-002's 1536 dims for a corpus this size, at a third of the vector storage/bandwidth and a fraction of the API price. Changing these requires a reindex (run with resetDatabase=True).
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_DIMENSIONS = 512
+
 
 
 
@@ -39,7 +50,80 @@ def countTokens(string):
     """Returns the number of tokens in a text string."""
     return len(oiaEncoding.encode(string))
 
+def countTokensBatch(texts):
+    """Returns the token counts for a whole list of strings, via one batched tiktoken call. The batch call crosses into tiktoken's native code once (instead of once per string) and fans the encoding out across all cores, so this is the way to count anything we have in bulk.
+
+    Args:
+        texts ([string]): The strings to count.
+
+    Returns:
+        [int]: token count for each input string, in order.
+    """
+    return [len(tokens) for tokens in oiaEncoding.encode_batch(texts, num_threads=os.cpu_count())]
+
+
+
+
+class RateLimiter:
+    """Paces requests to stay under a requests-per-minute limit, only sleeping when we're actually ahead of the allowed rate. (The old approach slept a fixed 30ms after every insert, which stalled the whole import even when we were nowhere near the limit.)
+    """
+
+    def __init__(self, rpm):
+        """Args:
+            rpm (int): Maximum requests per minute to allow.
+        """
+        self.interval = 60 / rpm
+        self.next_t = time.monotonic()
 
+    def reserve(self):
+        """Claim the next request slot and return how many seconds the caller should wait before using it (0 if we're under the rate). Split out from acquire() so async callers can await the delay instead of blocking the event loop."""
+        now = time.monotonic()
+        delay = max(0, self.next_t - now)
+        self.next_t = max(now, self.next_t) + self.interval
+        return delay
+
+    def acquire(self):
+        """Block until we're allowed to make the next request. Returns immediately if we're under the rate."""
+        time.sleep(self.reserve())
+
+
+class EmbeddingCache:
+    """On-disk cache of chunk embeddings, keyed by a hash of the chunk text. Re-running the builder (which happens a lot while iterating on the schema or the manifest) used to re-pay OpenAI for every unchanged chunk; with the cache, identical text costs one sqlite read instead of an API call.
+    """
+
+    def __init__(self, path='.embed_cache.sqlite'):
+        """Args:
+            path (string, optional): The sqlite file to keep the cache in. Defaults to '.embed_cache.sqlite' next to this script.
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, dim INT, vec BLOB)')
+        self.db.commit()
+
+    def _key(self, text):
+        """Hash key for a chunk text. The model name and dimensions are mixed in, so switching embedding models invalidates the cache instead of returning vectors from the wrong model."""
+        return hashlib.sha256(('{model}/{dims}'.format(model=EMBEDDING_MODEL, dims=EMBEDDING_DIMENSIONS) + '\x00' + text).encode('utf-8')).digest()
+
+    def get(self, text):
+        """Returns the cached embedding vector for this text, or None on a cache miss."""
+        row = self.db.execute('SELECT vec FROM embeddings WHERE hash=?', (self._key(text),)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put(self, text, vector):
+        """Store an embedding vector for this text (as float32 bytes, which is plenty of precision for cosine search)."""
+        self.db.execute(
+            'INSERT OR REPLACE INTO embeddings VALUES (?,?,?)',
+            (self._key(text), len(vector), np.asarray(vector, dtype=np.float32).tobytes())
+        )
+        self.db.commit()
+
+
+embedding_cache = EmbeddingCache()
+
+
+# Rate limit for the embedding requests we make ourselves in embedAll. Each limiter slot is one batched Embedding.acreate call covering up to 256 chunks, so the effective chunk throughput is ~256x the RPM; the default matches OpenAI's tier-1 3000 RPM, override via environment if yours differs.
+embeddings_limiter = RateLimiter(rpm=int(os.environ.get('OPENAI_EMBEDDINGS_RPM', '3000')))
 
 
 def weaviate_setup(resetDatabase=False):
@@ -53,15 +137,21 @@ def weaviate_setup(resetDatabase=False):
         Weaviate client object: The weaviate client
     """
 
-    # Connect to Weaviate
+    # Connect to Weaviate. (This is the v3 REST client; the v4 client's gRPC batch path would cut JSON serialization overhead on import, but v4 drops weaviate.Client entirely and the query side in gradioserver.py is written against the v3 API too -- so moving the builder alone would split the two apps across incompatible client versions. Revisit if/when the server migrates.)
     weaviate_client = weaviate.Client(
         url="http://localhost:8080/",
         additional_headers={
             "X-OpenAI-Api-Key": openai.api_key
-        }
+        },
+        # (connect, read) timeouts: batch flushes of 100 objects can legitimately take a while, so give reads more room than the default. This one client instance is shared by all the concurrent document tasks, which keeps everything on one keepalive connection pool.
+        timeout_config=(30, 120),
     )
     assert weaviate_client.is_ready()
 
+    # The schema below uses features an older server silently lacks or outright rejects: text-embedding-3-small with `dimensions` in text2vec-openai, and binary quantization. docker-compose pins a new-enough image (1.24), but fail loudly here in case someone points this at a stale server.
+    server_version = tuple(int(part) for part in weaviate_client.get_meta()['version'].split('.')[:2])
+    assert server_version >= (1, 24), 'Weaviate server is {version}; the DocumentChunk schema needs 1.24+ (3-series embedding models with dimensions, bq)'.format(version=weaviate_client.get_meta()['version'])
+
 
     # The schema specification for the Weaviate embedding index
     document_schema = {
@@ -70,11 +160,19 @@ def weaviate_setup(resetDatabase=False):
         "vectorizer": "text2vec-openai",
         "moduleConfig": {
             "text2vec-openai": {
-            "model": "ada",
-            "modelVersion": "002",
+            "model": EMBEDDING_MODEL,
+            "dimensions": EMBEDDING_DIMENSIONS,
             "type": "text"
             }
         },
+        # Binary quantization: vectors are stored as 1 bit per dimension (32x smaller than fp32), and candidate distances become a hardware popcount over XOR'd bits. rescoreLimit re-ranks the top candidates against the full-precision vectors so recall doesn't suffer, and the cache keeps the quantized vectors in RAM.
+        "vectorIndexConfig": {
+            "bq": {
+                "enabled": True,
+                "rescoreLimit": 200,
+                "cache": True
+            }
+        },
         "properties": [{
             "name": "documentId",
             "description": "ID of the document",
@@ -105,6 +203,14 @@ def weaviate_setup(resetDatabase=False):
     }
     
     
+    # Configure batching once, here, rather than per document. 100 objects per HTTP request is in line with Weaviate's import guidance; dynamic mode lets the client adjust and backpressure on its own.
+    weaviate_client.batch.configure(
+        batch_size=100,
+        dynamic=True,
+        timeout_retries=3,
+    #   callback=None,
+    )
+
     # if we're resetting the database
     if resetDatabase:
         # Delete all of the exiting schemas
@@ -114,6 +220,10 @@ def weaviate_setup(resetDatabase=False):
         # Create a new collection with the new schema
         weaviate_client.schema.create_class(document_schema)
 
+        # Servers that predate bq (or that don't recognize the option) can silently drop it from vectorIndexConfig rather than erroring, leaving us with full-precision vectors and none of the memory savings. Read the class back and make sure bq actually took.
+        created_class = weaviate_client.schema.get("DocumentChunk")
+        assert created_class.get('vectorIndexConfig', {}).get('bq', {}).get('enabled'), 'binary quantization was not enabled on the DocumentChunk class -- check the Weaviate server version'
+
     assert weaviate_client.schema.get() 
     
     return weaviate_client
@@ -123,6 +233,28 @@ def weaviate_setup(resetDatabase=False):
 
 
 
+def iterScienceParseSections(spJsonFileName):
+    """Yields the "sections" from a Science Parse JSON file, one at a time.
+
+    With ijson this streams the file incrementally, so the first section comes out (and chunking/embedding can start) before the whole file is parsed, and memory stays bounded no matter how big the parse output is. json.load built the entire object graph up front just so we could read metadata.sections. If ijson isn't installed, we fall back to doing exactly that.
+
+    Args:
+        spJsonFileName (string): filename of the Science Parse JSON output.
+
+    Returns: an iterator over the section dicts.
+    """
+    try:
+        import ijson
+    except ImportError:
+        with open(spJsonFileName, 'r', buffering=1<<20) as f:
+            data = json.load(f)
+        yield from data['metadata']['sections']
+        return
+
+    with open(spJsonFileName, 'rb', buffering=1<<20) as f:
+        yield from ijson.items(f, 'metadata.sections.item')
+
+
 def getChunks(spJsonFileName):
     """Loads a JSON file output from ScienceParse, break/merge them into chunks
 
@@ -132,42 +264,118 @@ def getChunks(spJsonFileName):
     Returns:
         ({string 'header', string 'content'}): an iterator over the chunks, with their heading and content in a dict.
     """
-    
-    # Grab the "sections" output by Science Parse, from Science Parse's outputted JSON.
-    with open(spJsonFileName, 'r') as f:
-        data = json.load(f)
-    sections = data['metadata']['sections']
 
-    # Keep this external to the loop since we sometimes merge paragraphs together into a single chunk.
-    chunk_in_progress = ''
-    
     # Loop over all of the sections (as identified by Science Parse.)
-    for section in sections:
-        
+    for section in iterScienceParseSections(spJsonFileName):
+
         header = section['heading']
         content = section['text']
-        
-        # if the section is less than 200 tokens, just return it as a chunk
-        if countTokens(content) < 200:
+
+        # Skip sections with no actual text -- an empty chunk would still cost an embedding call and an index slot.
+        if not content or not content.strip():
+            continue
+
+        # Cheap prefilter before any tokenizing: English prose runs about 4 bytes per cl100k token, so a section under 400 UTF-8 bytes is comfortably below the 200-token cutoff -- yield it as one chunk on the strength of a single len() instead of a BPE encode. (Most sections in these documents are short, so this skips tokenization for the common case; the cutoffs were always approximate anyway.)
+        if len(content.encode('utf-8')) < 400:
             yield {'header':header,'content':content}
-            
+            continue
+
+        # Count every paragraph of the section once, in one batched tiktoken call, and then work with the per-paragraph counts. We used to re-encode the whole growing chunk on every paragraph append, which was quadratic in the section length.
+        paragraphs = content.split('\n')
+        paragraph_token_counts = countTokensBatch(paragraphs)
+
+        # if the section is less than 200 tokens, just return it as a chunk. (Summing the paragraph counts plus one token per newline is a close-enough stand-in for encoding the whole section again.)
+        if sum(paragraph_token_counts) + len(paragraphs) - 1 < 200:
+            yield {'header':header,'content':content}
+
         # else, split it into paragraphs/newlines, and return each of them as its own chunk. Except to try to lump togeather really short chunks, combine adjacent chunks that are less than 100 tokens. (This is mostly because the documents have lots of bulleted lists and SP identifies each item as a paragraph; we want to merge adjacent ones together to keep them in context, to some extent.)
         else:
-            chunk_in_progress = ''
-            for paragraph in content.split('\n'):
-                chunk_in_progress += '\n' + paragraph
-                if countTokens(chunk_in_progress) > 100:
-                    yield {'header':header,'content':chunk_in_progress.strip()}
-                    chunk_in_progress = ''
-                    
-            yield {'header':header,'content':chunk_in_progress.strip()}
+            # Buffer the paragraphs in a list and join at yield time -- appending to a string reallocated the whole growing chunk on every paragraph.
+            chunk_paragraphs = []
+            running_tokens = 0
+            for paragraph, paragraph_tokens in zip(paragraphs, paragraph_token_counts):
+                chunk_paragraphs.append(paragraph)
+                running_tokens += paragraph_tokens + 1 # +1 for the newline
+                if running_tokens > 100:
+                    chunk_content = '\n'.join(chunk_paragraphs).strip()
+                    if chunk_content:
+                        yield {'header':header,'content':chunk_content}
+                    chunk_paragraphs = []
+                    running_tokens = 0
+
+            # Flush whatever's left -- but a section that ended exactly on a chunk boundary leaves nothing here, and the old unconditional yield sent that empty chunk off to be embedded.
+            chunk_content = '\n'.join(chunk_paragraphs).strip()
+            if chunk_content:
+                yield {'header':header,'content':chunk_content}
             
             
 
 
 
-def indexChunks(filename, documentId, documentTitle, weaviate_client):
-    """For one document, this function separates it into chunks and loads them into the embeddings index.
+# Hashes of every chunk text indexed so far in this run, shared across documents so cross-document boilerplate only gets embedded once. (Safe to share without a lock -- the document tasks all run on one asyncio event loop.)
+_seen_chunk_hashes = set()
+
+
+async def embedBatch(texts, semaphore):
+    """Embed one batch of texts with a single OpenAI API call. (Paced by the shared rate limiter, and capped by the semaphore so we don't open unbounded concurrent requests.)
+
+    Args:
+        texts ([string]): Up to ~256 chunk texts to embed together.
+        semaphore (asyncio.Semaphore): Caps how many embedding requests are in flight at once.
+
+    Returns:
+        [[float]]: One embedding vector per input text, in order.
+    """
+    # aiohttp has no equivalent of requests' retrying adapter, so retry transient failures here ourselves -- without this, a single 429 or 5xx would bubble out of asyncio.gather and abort the whole ingestion run half-indexed. Same policy as the pooled session in gradioserver.py: 5 attempts, exponential backoff starting at half a second. The semaphore is released while we back off, so a throttled batch doesn't hold up a slot.
+    for attempt in range(5):
+        async with semaphore:
+            delay = embeddings_limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                response = await openai.Embedding.acreate(model=EMBEDDING_MODEL, input=texts, dimensions=EMBEDDING_DIMENSIONS)
+            except (openai.error.RateLimitError, openai.error.APIError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError, openai.error.Timeout) as e:
+                if attempt == 4:
+                    raise
+                backoff = 0.5 * (2 ** attempt)
+                print(f"Embedding batch failed ({e.__class__.__name__}), retrying in {backoff}s")
+            else:
+                return [item['embedding'] for item in response['data']]
+        await asyncio.sleep(backoff)
+
+
+async def embedAll(texts, batch_size=256, concurrency=35):
+    """Embed all of the given texts, splitting them into batches and running the API calls concurrently. Relying on Weaviate's text2vec module meant one serial OpenAI round-trip per object; doing it ourselves with concurrent batched calls overlaps all that network latency.
+
+    Args:
+        texts ([string]): All the chunk texts to embed.
+        batch_size (int, optional): How many texts per API call. Defaults to 256.
+        concurrency (int, optional): Maximum API calls in flight. Defaults to 35, comfortably under tier-1 limits.
+
+    Returns:
+        [[float]]: One embedding vector per input text, in order.
+    """
+
+    # Check the on-disk cache first, and only send the misses to the API.
+    vectors = [embedding_cache.get(text) for text in texts]
+    miss_indices = [i for i, vector in enumerate(vectors) if vector is None]
+    print(f"Embedding {len(miss_indices)} chunks ({len(texts) - len(miss_indices)} cache hits)")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    miss_texts = [texts[i] for i in miss_indices]
+    batches = [miss_texts[i:i+batch_size] for i in range(0, len(miss_texts), batch_size)]
+    results = await asyncio.gather(*[embedBatch(batch, semaphore) for batch in batches])
+
+    # Slot the fresh vectors back into place, and remember them for next time.
+    for i, vector in zip(miss_indices, (v for batch_vectors in results for v in batch_vectors)):
+        vectors[i] = vector
+        embedding_cache.put(texts[i], vector)
+
+    return vectors
+
+
+async def indexChunks(filename, documentId, documentTitle, weaviate_client):
+    """For one document, this function separates it into chunks, computes their embeddings, and loads them into the embeddings index. (Async so that several documents can be in flight at once -- most of a document's wall-clock time is waiting on the embedding API.)
 
     Args:
         filename (string): Name of the JSON file, output from ScienceParse.
@@ -176,22 +384,34 @@ def indexChunks(filename, documentId, documentTitle, weaviate_client):
         weaviate_client: Weaviate client object
     """
     
-    weaviate_client.batch.configure(
-        batch_size=10, 
-        dynamic=True,
-        timeout_retries=3,
-    #   callback=None,
-    )
-    
-    
     print("Importing Document")
 
-    counter=0
-
-    # Separate the document into chunks, and insert each chunk into the vector index
-    for chunk in getChunks(filename):
+    # Separate the document into chunks, doing the (CPU-bound) JSON parse in a worker thread. Parsing inline would block the event loop, serializing it after the other documents' network waits; in a thread it overlaps with their in-flight embedding calls.
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(None, lambda: list(getChunks(filename)))
+
+    # Drop chunks whose exact text we've already indexed this run. Science Parse output repeats a lot of boilerplate (page headers/footers, copyright lines) across sections and documents, and every duplicate costs an embedding call and an index slot while adding nothing to retrieval.
+    deduplicated = []
+    duplicates = 0
+    for chunk in chunks:
+        chunk_hash = hashlib.blake2b(chunk['content'].strip().encode('utf-8'), digest_size=16).digest()
+        if chunk_hash in _seen_chunk_hashes:
+            duplicates += 1
+            continue
+        _seen_chunk_hashes.add(chunk_hash)
+        deduplicated.append(chunk)
+    if duplicates:
+        print(f"Skipped {duplicates} duplicate chunks")
+    chunks = deduplicated
+
+    # Compute all of the embeddings ourselves, in concurrent batched API calls. (When we left this to Weaviate's text2vec-openai module, it embedded one object at a time during insert, and that serial round-tripping was the bottleneck for the whole import.)
+    vectors = await embedAll([chunk['content'] for chunk in chunks])
+
+    # Insert each chunk into the vector index, attaching its precomputed vector -- Weaviate skips calling its vectorizer for objects that arrive with a vector. The batch object is entered once for the entire run (in the main block), so here we just add objects to it; even re-entering the context per document cost a lock acquire and a flush per entry, which adds up over the corpus.
+    batch = weaviate_client.batch
+    for counter, (chunk, vector) in enumerate(zip(chunks, vectors)):
         if (counter %100 == 0):
-            print(f"Import {counter} ") 
+            print(f"Import {counter} ")
 
         # record to indert, matching the index schema
         properties = {
@@ -201,17 +421,14 @@ def indexChunks(filename, documentId, documentTitle, weaviate_client):
             "header": chunk['header'],
             "content": chunk['content'],
         }
-        
-        # insert into the index     
-        with weaviate_client.batch as batch:
-           batch.add_data_object(properties, "DocumentChunk")
-        
-        # Sleep so we don't do too many openAI requests (since we have to call their API to compute an embedding for each chunk)        
-        time.sleep(60/2000)
-        
-        counter = counter+1
 
-    print("Importing Document complete")   
+        # insert into the index
+        batch.add_data_object(properties, "DocumentChunk", vector=vector)
+
+    # Flush this document's remainder so a later failure can't lose objects from an already-"complete" document.
+    batch.flush()
+
+    print("Importing Document complete")
 
 
 
@@ -262,30 +479,54 @@ def query_weaviate(query, weaviate_client, collection_name="DocumentChunk"):
 
 def load_document_information(filename='document-manifest.csv'):
     """
-    Open a CSV file that lists information about each document, and then yield them one document at a time.
+    Open the CSV file that lists information about each document, and return all the rows at once -- checking up front that every referenced JSON file actually exists. A missing file used to abort the run partway through, leaving a half-built index whose only fix is a full (embedding-expensive) re-index; now we find out before touching Weaviate at all.
+
+    Returns:
+        [dict]: one dict per manifest row.
     """
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        for line in reader:
-            yield line
+    with open(filename, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    for row in rows:
+        json_filename = 'documents-json/'+row['document_id']+'.pdf.json'
+        assert os.path.exists(json_filename), 'manifest references a missing file: ' + json_filename
+
+    return rows
 
 
 
 # If we're running this is a command, then load all the documents from document-manifest.csv and add them to the index.
 if __name__ == '__main__':
-    
-    # Set up the database connection    
+
+    # Read and sanity-check the whole manifest first, so a bad row can't abort us mid-ingest after we've already started writing to the index.
+    documents = load_document_information()
+
+    # Set up the database connection
     weaviate_client = weaviate_setup()
-    
-    # Iterate over all the documents in document-manifest.csv
-    for document in load_document_information():
-        #print(document)
-        
-        # Chunk it up and add it to the index
-        indexChunks(
-            filename='documents-json/'+document['document_id']+'.pdf.json',
-            documentId=document['document_id'],
-            documentTitle=document['document_name'],
-            weaviate_client=weaviate_client
-        )
-        
+
+    async def indexAllDocuments():
+        """Run the ingestion for every document in the manifest, keeping a few documents in flight at once. Each document's pipeline is mostly network waits (OpenAI embeddings, Weaviate inserts), so overlapping them gets the wall clock close to the slowest document instead of the sum of all of them. The semaphore keeps us from opening the whole manifest's worth of API requests at once."""
+        document_semaphore = asyncio.Semaphore(4)
+
+        # Hand the OpenAI library one shared keepalive session for all the embedding calls. Without it, the library opens a fresh session (TCP + TLS handshake) per request -- a fixed cost that dominates when the batches are small.
+        openai_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32))
+        openai.aiosession.set(openai_session)
+
+        async def indexOneDocument(document):
+            async with document_semaphore:
+                # Chunk it up and add it to the index
+                await indexChunks(
+                    filename='documents-json/'+document['document_id']+'.pdf.json',
+                    documentId=document['document_id'],
+                    documentTitle=document['document_name'],
+                    weaviate_client=weaviate_client
+                )
+
+        try:
+            await asyncio.gather(*[indexOneDocument(document) for document in documents])
+        finally:
+            await openai_session.close()
+
+    # One batch context around the entire run; exiting it flushes anything still buffered.
+    with weaviate_client.batch:
+        asyncio.run(indexAllDocuments())
@@ -10,55 +10,86 @@ Call like:  python weaviate_backup_restore backup 2
 
 
 import weaviate
-import os 
+import os
+import time
 
-WEAVIATE_HOST = os.environ['WEAVIATE_HOST']
-LOGGING_PATH = os.environ['LOGGING_PATH']
 DEFAULT_BACKUP_ID = '1' # We need to give backups an ID
 
 
-weaviate_client = weaviate.Client(
-        url="http://"+WEAVIATE_HOST+":8080/",
-        # additional_headers={
-        #     "X-OpenAI-Api-Key": openai_key.OPENAI_KEY
-        # }
-    )
-assert weaviate_client.is_ready()    
+def get_client():
+    """Connects to Weaviate and returns the client.
+
+    This happens in a function rather than at import time, so that running the script with bad arguments (or no WEAVIATE_HOST, or importing this module from somewhere else) doesn't pay a network round-trip -- or hang -- before we've even looked at argv.
+    """
+    weaviate_client = weaviate.Client(
+            url="http://"+os.environ['WEAVIATE_HOST']+":8080/",
+            # additional_headers={
+            #     "X-OpenAI-Api-Key": openai_key.OPENAI_KEY
+            # }
+        )
+    assert weaviate_client.is_ready()
+    return weaviate_client
+
+
 
 
+def wait_for_backup(status_fn, backup_id, backend="filesystem"):
+    """Polls the backup/restore status until the server reports it's finished, with exponential backoff between polls. (wait_for_completion=True made the client busy-poll while holding a synchronous HTTP request open for the entire server-side write, which can take a while -- this way the socket is released between polls, we can print progress, and ctrl-C actually works.)
+
+    Args:
+        status_fn: either weaviate_client.backup.get_create_status or .get_restore_status
+        backup_id (string): The backup ID being waited on.
+        backend (string, optional): The backup backend. Defaults to "filesystem".
+
+    Returns: the final status object from Weaviate.
+    """
+    started = time.monotonic()
+    delay = 1.0
+    while True:
+        status = status_fn(backup_id=backup_id, backend=backend)
+        if status['status'] in ('SUCCESS', 'FAILED'):
+            return status
+        print('...{status}, {elapsed:.0f}s elapsed'.format(status=status['status'], elapsed=time.monotonic()-started))
+        time.sleep(delay)
+        delay = min(delay * 1.5, 30)
 
 
 if __name__ == '__main__':
     from sys import argv
-    
+
+    # Validate the arguments before connecting to anything.
+    if len(argv) < 2 or argv[1] not in ('backup', 'restore'):
+        print('Please give an argument either "backup" or "restore," (followed optionally by a backup ID).')
+        raise SystemExit(1)
+
     # Get backup id if it's provided as the 2nd command-line argument
     backup_id = argv[2] if len(argv) > 2 else DEFAULT_BACKUP_ID
-    
+
+    weaviate_client = get_client()
+
     if argv[1] == 'backup':
-        # do backup
+        # kick off the backup, then poll until the server is done with it
         result = weaviate_client.backup.create(
             backup_id=backup_id,
             backend="filesystem",
             # include_classes=["DocumentChunk"], # it should include all classes if we don't provide this.
-            wait_for_completion=True,
+            wait_for_completion=False,
         )
         print(result)
-    
-    
-    
+        print(wait_for_backup(weaviate_client.backup.get_create_status, backup_id))
+
+
+
     elif argv[1] == 'restore':
         # clear out everything from Weaviate
         weaviate_client.schema.delete_all()
-        
-        # do restore
+
+        # kick off the restore, then poll until the server is done with it
         result = weaviate_client.backup.restore(
             backup_id=backup_id,
             backend="filesystem",
             # exclude_classes="Article",
-            wait_for_completion=True,
+            wait_for_completion=False,
         )
         print(result)
-        
-    
-    else:
-        print('Please give an argument either "backup" or "restore," (followed optionally by a backup ID).')
\ No newline at end of file
+        print(wait_for_backup(weaviate_client.backup.get_restore_status, backup_id))
\ No newline at end of file